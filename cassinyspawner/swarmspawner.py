@@ -3,15 +3,19 @@ A Spawner for JupyterHub that runs each user's
 server in a separate Docker Service
 """
 
+import asyncio
+import copy
 import hashlib
+import threading
+import time
 from textwrap import dedent
 from concurrent.futures import ThreadPoolExecutor
-from pprint import pformat
+from functools import partial
 
 import docker
 from docker.errors import APIError
 from docker.utils import kwargs_from_env
-from tornado import gen
+from tornado.ioloop import PeriodicCallback
 
 from jupyterhub.spawner import Spawner
 from traitlets import (
@@ -20,8 +24,82 @@ from traitlets import (
     List,
     Bool,
     Int,
+    Float,
+    Enum,
+    default,
 )
 
+_EMPTY_ENV_KEEP = ()
+
+# initialized hashers for service_owner, copied for each user
+_OWNER_HASHERS = {}
+
+
+def _owner_hasher(name):
+    """Return a new hasher for service_owner
+
+    The hasher is initialized on first use, so that MD5 is never
+    built when it's not selected (it raises on FIPS enabled hosts).
+    """
+    hasher = _OWNER_HASHERS.get(name)
+    if hasher is None:
+        if name == 'md5':
+            try:
+                hasher = hashlib.md5(usedforsecurity=False)
+            except TypeError:
+                # usedforsecurity needs Python 3.9
+                hasher = hashlib.md5()
+        else:
+            hasher = hashlib.blake2b(digest_size=16)
+        _OWNER_HASHERS[name] = hasher
+    return hasher.copy()
+
+
+def _is_template(value):
+    return '{' in value or '}' in value
+
+
+def _compile_mount(mount):
+    """Return a function building the docker.types.Mount of a mount spec
+    for a given service owner.
+
+    The parts of the spec without a template are built once, only the
+    templated source and driver device are formatted when it's called.
+    """
+    source = mount.get('source')
+    format_source = source is not None and _is_template(source)
+
+    driver_config = mount.get('driver_config')
+    device = None
+    if driver_config is not None:
+        device = driver_config.get('options', {}).get('device')
+    format_device = device is not None and _is_template(device)
+
+    static = mount.copy()
+    if format_source:
+        del static['source']
+    if format_device:
+        del static['driver_config']
+    elif driver_config is not None:
+        static['driver_config'] = docker.types.DriverConfig(**driver_config)
+
+    if not format_source and not format_device:
+        prebuilt = docker.types.Mount(**static)
+        return lambda owner: prebuilt
+
+    def build(owner):
+        m = {}
+        if format_source:
+            m['source'] = source.format(username=owner)
+        if format_device:
+            options = dict(driver_config['options'],
+                           device=device.format(username=owner))
+            m['driver_config'] = docker.types.DriverConfig(
+                **dict(driver_config, options=options))
+        return docker.types.Mount(**static, **m)
+
+    return build
+
 
 class UnicodeOrFalse(Unicode):
     info_text = 'a unicode string or False'
@@ -37,16 +115,22 @@ class SwarmSpawner(Spawner):
     """
 
     _executor = None
+    _executor_lock = threading.Lock()
 
     @property
-    def executor(self, max_workers=1):
+    def executor(self):
         """single global executor"""
         cls = self.__class__
         if cls._executor is None:
-            cls._executor = ThreadPoolExecutor(max_workers)
+            with cls._executor_lock:
+                if cls._executor is None:
+                    cls._executor = ThreadPoolExecutor(
+                        max_workers=self.executor_workers,
+                        thread_name_prefix="swarmspawner")
         return cls._executor
 
     _client = None
+    _client_lock = threading.Lock()
 
     @property
     def client(self):
@@ -54,15 +138,137 @@ class SwarmSpawner(Spawner):
         cls = self.__class__
 
         if cls._client is None:
-            kwargs = {}
-            if self.tls_config:
-                kwargs['tls'] = docker.tls.TLSConfig(**self.tls_config)
-            kwargs.update(kwargs_from_env())
-            client = docker.APIClient(version='auto', **kwargs)
-
-            cls._client = client
+            with cls._client_lock:
+                if cls._client is None:
+                    kwargs = {}
+                    if self.tls_config:
+                        kwargs['tls'] = docker.tls.TLSConfig(**self.tls_config)
+                    kwargs.update(kwargs_from_env())
+                    # one connection for each thread of the executor,
+                    # plus one held by the events stream
+                    client = docker.APIClient(
+                        version='auto',
+                        max_pool_size=self.executor_workers + 1,
+                        **kwargs)
+
+                    cls._client = client
+                    cls._events_thread = threading.Thread(
+                        target=cls._consume_events,
+                        args=(client, self.service_prefix,
+                              self.service_cache_ttl, self.log),
+                        name="swarmspawner-events", daemon=True)
+                    cls._events_thread.start()
         return cls._client
 
+    _events_thread = None
+    _service_state = {}
+
+    @classmethod
+    def _consume_events(cls, client, prefix, ttl, log):
+        """Follow the events of the swarm services
+
+        Runs forever in a daemon thread, reconnecting with a backoff.
+        """
+        delay = 1
+        while True:
+            try:
+                events = client.events(filters={'type': 'service'}, decode=True)
+                delay = 1
+                for event in events:
+                    cls._record_event(event, prefix, ttl)
+            except Exception:
+                log.exception(
+                    "Error following the Docker service events, retrying in %ss",
+                    delay)
+            # events may have been missed, forget what we know
+            cls._service_state.clear()
+            time.sleep(delay)
+            delay = min(delay * 2, 60)
+
+    executor_workers = Int(
+        16, min=1, config=True,
+        help=dedent(
+            """
+            Number of threads used to call the Docker API.
+            The pool is shared by all the spawners of the hub.
+            """
+        )
+    )
+
+    _service_cache = {}
+    _service_invalidated = {}
+    _services_refresher = None
+
+    @classmethod
+    def _cache_service(cls, name, service, since):
+        """Store an inspected service in the cache
+
+        `since` is the time the Docker call started: the result is
+        dropped if the service was invalidated in the meantime.
+        """
+        if cls._service_invalidated.get(name, 0) < since:
+            cls._service_cache[name] = (since, service)
+
+    @classmethod
+    def _invalidate_service(cls, name):
+        cls._service_cache.pop(name, None)
+        cls._service_invalidated[name] = time.monotonic()
+
+    @classmethod
+    def _record_event(cls, event, prefix, ttl):
+        """Record the last action (create, update, remove) seen for a
+        service of this hub and drop its stale cached inspection"""
+        name = event['Actor']['Attributes'].get('name')
+        if name is None or not name.startswith(prefix + '-'):
+            return
+        cls._service_state[name] = event['Action']
+        cls._invalidate_service(name)
+        cls._forget_services(ttl)
+
+    @classmethod
+    def _forget_services(cls, ttl):
+        """Forget the invalidations older than `ttl`, and the services
+        removed by then
+
+        An inspection started before such an invalidation is already
+        expired, it doesn't need to be kept out of the cache anymore.
+        """
+        expired = time.monotonic() - ttl
+        for name, invalidated in list(cls._service_invalidated.items()):
+            if invalidated >= expired:
+                continue
+            if cls._service_state.get(name) == 'remove':
+                cls._service_state.pop(name, None)
+            # unless it was invalidated again meanwhile
+            if cls._service_invalidated.get(name) == invalidated:
+                cls._service_invalidated.pop(name, None)
+
+    service_cache_ttl = Float(
+        2.0, config=True,
+        help=dedent(
+            """
+            Seconds for which the result of a service inspection is reused
+            before asking Docker again. Set to 0 to disable the cache.
+            """
+        )
+    )
+
+    max_concurrent_docker_calls = Int(
+        min=1, config=True,
+        help=dedent(
+            """
+            Maximum number of Docker API calls submitted at the same time.
+            The calls above this limit wait in the hub event loop,
+            where they can be cancelled, instead of the executor queue.
+            Defaults to `executor_workers`.
+            """
+        )
+    )
+
+    @default('max_concurrent_docker_calls')
+    def _default_max_concurrent_docker_calls(self):
+        return self.executor_workers
+
     service_id = Unicode()
     service_port = Int(8888, min=1, max=65535, config=True)
     service_image = Unicode("jupyterhub/singleuser", config=True)
@@ -76,6 +282,16 @@ class SwarmSpawner(Spawner):
             """
         )
     )
+    service_owner_hash = Enum(
+        ['md5', 'blake2b'], 'md5', config=True,
+        help=dedent(
+            """
+            Hash used to derive service_owner from the user name.
+            'blake2b' is meant for new deployments: changing it renames
+            the services and the {username} volumes of existing users.
+            """
+        )
+    )
     tls_config = Dict(
         config=True,
         help=dedent(
@@ -123,11 +339,13 @@ class SwarmSpawner(Spawner):
     @property
     def service_owner(self):
         if self._service_owner is None:
-            m = hashlib.md5()
+            m = _owner_hasher(self.service_owner_hash)
             m.update(self.user.name.encode('utf-8'))
             self._service_owner = m.hexdigest()
         return self._service_owner
 
+    _service_name = None
+
     @property
     def service_name(self):
         """
@@ -136,15 +354,71 @@ class SwarmSpawner(Spawner):
         service_suffix should be a numerical value unique for user
         {service_prefix}-{service_owner}-{service_suffix}
         """
-        if hasattr(self, "server_name") and self.server_name:
-            server_name = self.server_name
-        else:
-            server_name = 1
+        if self._service_name is None:
+            if hasattr(self, "server_name") and self.server_name:
+                server_name = self.server_name
+            else:
+                server_name = 1
+
+            self._service_name = "{}-{}-{}".format(self.service_prefix,
+                                                   self.service_owner,
+                                                   server_name
+                                                   )
+        return self._service_name
+
+    @classmethod
+    async def refresh_services_cache(cls, client, prefix):
+        """Inspect all the services spawned by the hub with a single call
+        and store them in the service cache"""
+        async with cls._semaphore:
+            since = time.monotonic()
+            future = cls._executor.submit(
+                client.services, filters={'name': prefix + '-'})
+            services = await asyncio.wrap_future(future)
+        for service in services:
+            cls._cache_service(service['Spec']['Name'], service, since)
+
+    def _start_services_refresher(self):
+        """Keep the service cache filled for all the users,
+        instead of inspecting each service on its own
+
+        It's started after a Docker call, once the client, the executor
+        and the semaphore exist. It runs twice per TTL, so that the
+        entries are refreshed before they expire.
+        """
+        cls = self.__class__
+        if cls._services_refresher is None and self.service_cache_ttl:
+            cls._services_refresher = PeriodicCallback(
+                partial(cls.refresh_services_cache,
+                        cls._client, self.service_prefix),
+                self.service_cache_ttl * 1000 / 2)
+            cls._services_refresher.start()
 
-        return "{}-{}-{}".format(self.service_prefix,
-                                 self.service_owner,
-                                 server_name
-                                 )
+    _compiled_container_spec = None
+
+    def _compile_container_spec(self, container_spec):
+        """Split a container spec into its image, the constant
+        docker.types.ContainerSpec arguments and the mount builders
+
+        The result is shared by the spawners
+        for as long as the container spec doesn't change.
+        """
+        cls = self.__class__
+        compiled = cls._compiled_container_spec
+        if compiled is None or compiled[0] != container_spec:
+            if 'Image' not in container_spec:
+                raise ValueError(
+                    "A container_spec with an Image is needed to create a service")
+            container_spec = copy.deepcopy(container_spec)
+            kwargs = container_spec.copy()
+            image = kwargs.pop('Image')
+            mounts = kwargs.pop('mounts', [])
+            # the env is always the one of get_env()
+            kwargs.pop('env', None)
+            builders = [_compile_mount(mount) for mount in mounts]
+            compiled = (container_spec, image, kwargs, builders)
+            cls._compiled_container_spec = compiled
+        return compiled[1:]
 
     def load_state(self, state):
         super().load_state(state)
@@ -159,16 +433,20 @@ class SwarmSpawner(Spawner):
     def _env_keep_default(self):
         """it's called in traitlets. It's a special method name.
         Don't inherit any env from the parent process"""
-        return []
+        return _EMPTY_ENV_KEEP
+
+    _public_hub_api_url_cached = None
 
     def _public_hub_api_url(self):
-        proto, path = self.hub.api_url.split('://', 1)
-        _, rest = path.split(':', 1)
-        return '{proto}://{name}:{rest}'.format(
-            proto=proto,
-            name=self.jupyterhub_service_name,
-            rest=rest
-        )
+        if self._public_hub_api_url_cached is None:
+            proto, path = self.hub.api_url.split('://', 1)
+            _, rest = path.split(':', 1)
+            self._public_hub_api_url_cached = '{proto}://{name}:{rest}'.format(
+                proto=proto,
+                name=self.jupyterhub_service_name,
+                rest=rest
+            )
+        return self._public_hub_api_url_cached
 
     def get_env(self):
         env = super().get_env()
@@ -194,35 +472,51 @@ class SwarmSpawner(Spawner):
         m = getattr(self.client, method)
         return m(*args, **kwargs)
 
-    def docker(self, method, *args, **kwargs):
+    _semaphore = None
+
+    @property
+    def semaphore(self):
+        """single global semaphore bounding the pending docker calls"""
+        cls = self.__class__
+        if cls._semaphore is None:
+            cls._semaphore = asyncio.Semaphore(self.max_concurrent_docker_calls)
+        return cls._semaphore
+
+    async def docker(self, method, *args, **kwargs):
         """Call a docker method in a background thread
 
-        returns a Future
+        returns the result of the call
         """
-        return self.executor.submit(self._docker, method, *args, **kwargs)
+        async with self.semaphore:
+            future = self.executor.submit(self._docker, method, *args, **kwargs)
+            return await asyncio.wrap_future(future)
 
-    @gen.coroutine
-    def poll(self):
+    async def poll(self):
         """Check for a task state like `docker service ps id`"""
-        service = yield self.get_service()
+        if self._service_state.get(self.service_name) == 'remove':
+            self.log.warn("Docker service removed")
+            return 0
+
+        service = await self.get_service()
         if not service:
             self.log.warn("Docker service not found")
             return 0
 
         task_filter = {'service': service['Spec']['Name']}
 
-        tasks = yield self.docker(
+        tasks = await self.docker(
             'tasks', task_filter
         )
 
+        sid7 = self.service_id[:7]
         running_task = None
         for task in tasks:
             task_state = task['Status']['State']
             self.log.debug(
                 "Task %s of Docker service %s status: %s",
                 task['ID'][:7],
-                self.service_id[:7],
-                pformat(task_state),
+                sid7,
+                task_state,
             )
             if task_state == 'running':
                 # there should be at most one running task
@@ -233,15 +527,25 @@ class SwarmSpawner(Spawner):
         else:
             return 1
 
-    @gen.coroutine
-    def get_service(self):
+    async def get_service(self, use_cache=True):
         self.log.debug("Getting Docker service '%s'", self.service_name)
+
+        cached = self._service_cache.get(self.service_name)
+        if use_cache and cached is not None:
+            timestamp, service = cached
+            if time.monotonic() - timestamp < self.service_cache_ttl:
+                self.service_id = service['ID']
+                return service
+
         try:
-            service = yield self.docker(
+            since = time.monotonic()
+            service = await self.docker(
                 'inspect_service', self.service_name
             )
             self.service_id = service['ID']
+            self._cache_service(self.service_name, service, since)
         except APIError as err:
+            self._invalidate_service(self.service_name)
             if err.response.status_code == 404:
                 self.log.info("Docker service '%s' is gone", self.service_name)
                 service = None
@@ -254,10 +558,10 @@ class SwarmSpawner(Spawner):
                 self.service_id = ''
             else:
                 raise
+        self._start_services_refresher()
         return service
 
-    @gen.coroutine
-    def start(self):
+    async def start(self):
         """Start the single-user server in a docker service.
         You can specify the params for the service through jupyterhub_config.py
         or using the user_options
@@ -270,47 +574,31 @@ class SwarmSpawner(Spawner):
         else:
             user_options = {}
 
-        self.log.warn("user_options: {}".format(user_options))
+        self.log.debug("user_options: %s", user_options)
 
-        service = yield self.get_service()
+        # a cached service may have been removed since
+        service = await self.get_service(use_cache=False)
 
         if service is None:
 
             if 'name' in user_options:
                 self.server_name = user_options['name']
+                # the service name depends on the server name
+                self._service_name = None
 
-            if hasattr(self, 'container_spec') and self.container_spec is not None:
-                container_spec = dict(**self.container_spec)
-            elif user_options == {}:
-                raise("A container_spec is needed in to create a service")
+            container_spec = self.container_spec
+            if user_options.get('container_spec'):
+                container_spec = dict(container_spec,
+                                      **user_options['container_spec'])
 
-            container_spec.update(user_options.get('container_spec', {}))
+            image, container_kwargs, builders = self._compile_container_spec(
+                container_spec)
 
-            # iterates over mounts to create
             # a new mounts list of docker.types.Mount
-            container_spec['mounts'] = []
-            for mount in self.container_spec['mounts']:
-                m = dict(**mount)
-
-                if 'source' in m:
-                    m['source'] = m['source'].format(
-                        username=self.service_owner)
-
-                if 'driver_config' in m:
-                    device = m['driver_config']['options']['device'].format(
-                        username=self.service_owner
-                    )
-                    m['driver_config']['options']['device'] = device
-                    m['driver_config'] = docker.types.DriverConfig(
-                        **m['driver_config'])
-
-                container_spec['mounts'].append(docker.types.Mount(**m))
-
-            # some Envs are required by the single-user-image
-            container_spec['env'] = self.get_env()
+            mounts = [build(self.service_owner) for build in builders]
 
             if hasattr(self, 'resource_spec'):
-                resource_spec = self.resource_spec
+                resource_spec = self.resource_spec.copy()
             resource_spec.update(user_options.get('resource_spec', {}))
 
             if hasattr(self, 'networks'):
@@ -323,12 +611,10 @@ class SwarmSpawner(Spawner):
             if user_options.get('placement') is not None:
                 placement = user_options.get('placement')
 
-            image = container_spec['Image']
-            del container_spec['Image']
-
             # create the service
+            # some Envs are required by the single-user-image
             container_spec = docker.types.ContainerSpec(
-                image, **container_spec)
+                image, env=self.get_env(), mounts=mounts, **container_kwargs)
             resources = docker.types.Resources(**resource_spec)
 
             task_spec = {'container_spec': container_spec,
@@ -337,12 +623,14 @@ class SwarmSpawner(Spawner):
                          }
             task_tmpl = docker.types.TaskTemplate(**task_spec)
 
-            resp = yield self.docker('create_service',
+            resp = await self.docker('create_service',
                                      task_tmpl,
                                      name=self.service_name,
                                      networks=networks)
 
             self.service_id = resp['ID']
+            # don't depend on the events thread to forget a previous removal
+            self._service_state.pop(self.service_name, None)
 
             self.log.info(
                 "Created Docker service '%s' (id: %s) from image %s",
@@ -356,10 +644,8 @@ class SwarmSpawner(Spawner):
             # Get the API token from the environment variables
             # of the running service:
             envs = service['Spec']['TaskTemplate']['ContainerSpec']['Env']
-            for line in envs:
-                if line.startswith('JPY_API_TOKEN='):
-                    self.api_token = line.split('=', 1)[1]
-                    break
+            env_map = dict(e.split('=', 1) for e in envs if '=' in e)
+            self.api_token = env_map.get('JPY_API_TOKEN', self.api_token)
 
         ip = self.service_name
         port = self.service_port
@@ -369,18 +655,19 @@ class SwarmSpawner(Spawner):
         # service_port is actually equal to 8888
         return (ip, port)
 
-    @gen.coroutine
-    def stop(self, now=False):
+    async def stop(self, now=False):
         """Stop and remove the service
 
         Consider using stop/start when Docker adds support
         """
+        sid7 = self.service_id[:7]
         self.log.info(
             "Stopping and removing Docker service %s (id: %s)",
-            self.service_name, self.service_id[:7])
-        yield self.docker('remove_service', self.service_id[:7])
+            self.service_name, sid7)
+        await self.docker('remove_service', sid7)
+        self._invalidate_service(self.service_name)
         self.log.info(
             "Docker service %s (id: %s) removed",
-            self.service_name, self.service_id[:7])
+            self.service_name, sid7)
 
         self.clear_state()
@@ -1,19 +1,19 @@
 # Copyright (c) Cassiny.io OÜ.
 
-import re
-from setuptools import setup, find_packages
+from setuptools import setup
 from pathlib import Path
 
 
 with (Path(__file__).parent / 'cassinyspawner' / '__init__.py').open() as fp:
-    try:
-        version = re.findall(r"^__version__ = '([^']+)'\r?$",
-                             fp.read(), re.M)[0]
-    except IndexError:
+    for line in fp:
+        if line.startswith('__version__'):
+            version = line.split('=', 1)[1].strip().strip('\'"')
+            break
+    else:
         raise RuntimeError('Unable to determine version.')
 
 with open('./requirements/base.txt') as test_reqs_txt:
-    requirements = list(iter(test_reqs_txt))
+    requirements = test_reqs_txt.read().splitlines()
 
 long_description = open('README.rst').read()
 
@@ -35,13 +35,12 @@ setup(
         'Intended Audience :: Developers',
         'Topic :: Software Development :: Libraries :: Python Modules',
         'License :: OSI Approved :: BSD License',
-        'Programming Language :: Python :: 3.3',
-        'Programming Language :: Python :: 3.4',
-        'Programming Language :: Python :: 3.5',
-        'Programming Language :: Python :: 3.6',
+        'Programming Language :: Python :: 3',
+        'Programming Language :: Python :: 3 :: Only',
     ],
     keywords=['Interactive', 'Interpreter', 'Shell', 'Web'],
-    packages=find_packages(exclude=['contrib', 'docs', 'tests']),
+    packages=['cassinyspawner'],
+    python_requires='>=3.6',
     install_requires=requirements,
     extras_require={},
 )
@@ -1,82 +1,249 @@
 """Define fixtures for SwarmSpawner tests."""
 
+import hashlib
 import os
+import pathlib
+import threading
 import time
 
-import docker
 import pytest
 
 
 HUB_IMAGE_TAG = "hub:test"
 NETWORK_NAME = "jh_test"
 HUB_SERVICE_NAME = "jupyterhub"
+HUB_API_URL = "http://127.0.0.1:8000/hub/api"
+HUB_START_TIMEOUT = 60
+# Building the hub image from scratch is the slowest part of the setup
+PREWARM_TIMEOUT = 600
+HUB_TASK_ENDED = {"complete", "failed", "shutdown", "rejected"}
+
+# Label of the hub image storing the digest of its build context
+CONTEXT_LABEL = "swarmspawner.ctx"
 
 CONFIG_TEMPLATE_PATH = "tests/jupyter_config.j2"
 
-@pytest.fixture(scope="session")
-def swarm():
+_REPO_ROOT = pathlib.Path(__file__).resolve().parents[1]
+_TESTS_DIR = _REPO_ROOT / "tests"
+_CONFIG_HOST = str(_TESTS_DIR / "jupyter_config.py")
+# The hub talks to the docker daemon of the host, and reads the test config
+_HUB_MOUNTS = ["/var/run/docker.sock:/var/run/docker.sock:rw",
+               _CONFIG_HOST + ":/srv/jupyterhub/jupyter_config.py:ro"]
+
+DOCKER_MAX_POOL_SIZE = 64
+_DOCKER_CLIENT = None
+_DOCKER_CLIENT_LOCK = threading.Lock()
+
+def _client():
+    """The docker client shared by the fixtures and the tests."""
+    global _DOCKER_CLIENT
+    with _DOCKER_CLIENT_LOCK:
+        if _DOCKER_CLIENT is None:
+            import docker
+            # Keep a connection for each of the threads calling the daemon at once
+            _DOCKER_CLIENT = docker.from_env(max_pool_size=DOCKER_MAX_POOL_SIZE)
+    return _DOCKER_CLIENT
+
+def context_files(path):
+    """List the files of a docker build context, respecting its .dockerignore."""
+    import docker
+
+    with open(os.path.join(path, ".dockerignore")) as fp:
+        patterns = [line.strip() for line in fp
+                    if line.strip() and not line.startswith("#")]
+    return sorted(name for name in docker.utils.exclude_paths(path, patterns)
+                  if os.path.isfile(os.path.join(path, name)))
+
+def context_digest(path):
+    """Hash the files of a docker build context."""
+    digest = hashlib.blake2b()
+    for name in context_files(path):
+        digest.update(name.encode("utf-8"))
+        with open(os.path.join(path, name), "rb") as fp:
+            digest.update(fp.read())
+    return digest.hexdigest()
+
+def swarm_is_active(client):
+    return client.info().get("Swarm", {}).get("LocalNodeState") == "active"
+
+def init_swarm(client):
     """Initialize the docker swarm that's going to run the servers
     as services.
     """
-    client = docker.from_env()
     client.swarm.init(advertise_addr="192.168.99.100")
-    yield client.swarm.attrs
-    client.swarm.leave(force=True)
+    return client.swarm.attrs
 
-@pytest.fixture(scope="session")
-def hub_image():
+def build_hub_image(client):
     """Build the image for the jupyterhub. We'll run this as a service
     that's going to then spawn the notebook server services.
+
+    The image is kept after the session, and only rebuilt when the build
+    context changes.
     """
-    client = docker.from_env()
+    import docker
 
     # Build the image from the root of the package
-    parent_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
-    image = client.images.build(path=parent_dir, tag=HUB_IMAGE_TAG, rm=True)
-    yield image
-    client.images.remove(image.tags[0])
-
-@pytest.fixture(scope="session")
-def network():
+    parent_dir = str(_REPO_ROOT)
+    digest = context_digest(parent_dir)
+
+    try:
+        image = client.images.get(HUB_IMAGE_TAG)
+    except docker.errors.ImageNotFound:
+        image = None
+
+    if image is None or image.labels.get(CONTEXT_LABEL) != digest:
+        old_image = image
+        # Use the low level API to consume the build output as it's streamed.
+        # The base image is pulled by the CI beforehand, don't pull it again.
+        output = client.api.build(path=parent_dir, tag=HUB_IMAGE_TAG, rm=True,
+                                  forcerm=False, nocache=False, pull=False,
+                                  labels={CONTEXT_LABEL: digest},
+                                  cache_from=[HUB_IMAGE_TAG], decode=True)
+        for chunk in output:
+            if "error" in chunk:
+                raise docker.errors.BuildError(chunk["error"], output)
+        image = client.images.get(HUB_IMAGE_TAG)
+        if old_image is not None and old_image.id != image.id:
+            try:
+                client.images.remove(old_image.id)
+            except docker.errors.APIError:
+                # still used by a container
+                pass
+    return image
+
+def create_network(client):
     """Create the overlay network that the hub and server services will
     use to communicate.
+
+    An existing network is reused, and the network is kept after the session.
     """
-    client = docker.from_env()
-    network = client.networks.create(
+    import docker
+
+    try:
+        return client.networks.get(NETWORK_NAME)
+    except docker.errors.NotFound:
+        pass
+    return client.networks.create(
         name=NETWORK_NAME,
         driver="overlay",
         options={"subnet": "192.168.0.0/20"},
         attachable=True)
-    yield network
-    network.remove()
 
 
-@pytest.fixture
-def hub_service(hub_image, swarm, network):
+# The swarm, the network and the hub image are set up in a background thread
+# as soon as a collected test needs them, so their setup overlaps with the
+# tests that don't need them.
+PREWARM_FIXTURES = {"swarm", "network", "hub_image", "hub_service"}
+_PREWARM = {"ready": threading.Event()}
+
+def _prewarm():
+    try:
+        client = _client()
+        # Reuse the swarm this node is already part of, and leave it in place
+        if swarm_is_active(client):
+            _PREWARM["swarm"] = client.swarm.attrs
+        else:
+            _PREWARM["swarm"] = init_swarm(client)
+            _PREWARM["leave_swarm"] = True
+        _PREWARM["network"] = create_network(client)
+        _PREWARM["hub_image"] = build_hub_image(client)
+    except Exception as err:
+        _PREWARM["error"] = err
+    finally:
+        _PREWARM["ready"].set()
+
+def _prewarmed(name):
+    if not _PREWARM["ready"].wait(PREWARM_TIMEOUT):
+        raise RuntimeError("The swarm, network and hub image weren't set up "
+                           "in {} seconds".format(PREWARM_TIMEOUT))
+    if "error" in _PREWARM:
+        raise _PREWARM["error"]
+    return _PREWARM[name]
+
+def pytest_collection_modifyitems(session, config, items):
+    if config.option.collectonly:
+        return
+    if not any(PREWARM_FIXTURES.intersection(item.fixturenames) for item in items):
+        return
+    _PREWARM["thread"] = threading.Thread(target=_prewarm, daemon=True)
+    _PREWARM["thread"].start()
+
+def pytest_sessionfinish(session):
+    """Tear down what the background thread set up, even if no test used it."""
+    if "thread" not in _PREWARM:
+        return
+    if not _PREWARM["ready"].wait(PREWARM_TIMEOUT):
+        raise RuntimeError("The swarm, network and hub image weren't set up "
+                           "in {} seconds".format(PREWARM_TIMEOUT))
+    if _PREWARM.get("leave_swarm"):
+        _client().swarm.leave(force=True)
+
+@pytest.fixture(scope="session")
+def docker_client():
+    return _client()
+
+@pytest.fixture(scope="session")
+def swarm():
+    return _prewarmed("swarm")
+
+@pytest.fixture(scope="session")
+def hub_image():
+    return _prewarmed("hub_image")
+
+@pytest.fixture(scope="session")
+def network():
+    return _prewarmed("network")
+
+
+@pytest.fixture(scope="session")
+def hub_service(hub_image, swarm, network, http_session):
     """Launch the hub service.
 
+    The hub is shared by the whole session, the tests remove the services it spawns.
+
     Note that we don't directly use any of the arguments, but those fixtures need to be
     in place before we can launch the service.
     """
+    import docker
+    import requests
 
-    client = docker.from_env()
-    config_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "jupyter_config.py")
+    client = _client()
     service = client.services.create(
         image=HUB_IMAGE_TAG,
         name=HUB_SERVICE_NAME,
-        mounts=[":".join(["/var/run/docker.sock", "/var/run/docker.sock", "rw"]),
-                ":".join([config_path, "/srv/jupyterhub/jupyter_config.py", "ro"])],
+        mounts=_HUB_MOUNTS,
         networks=[NETWORK_NAME],
-        endpoint_spec=docker.types.EndpointSpec(ports={8000: 8000}))
-
-    # Wait for the service's task to start running
-    while service.tasks() and service.tasks()[0]["Status"]["State"] != "running":
-        time.sleep(1)
-
-    # And wait some more. This is...not great, but there seems to be a period after the task
-    # is running but before the hub will accept connections. If the test code attempts to
-    # connect to the hub during that time, it fails.
-    time.sleep(10)
+        endpoint_spec=docker.types.EndpointSpec(ports={8000: 8000}),
+        # A hub failing to start should fail the tests, not be restarted with a backoff
+        mode=docker.types.ServiceMode("replicated", replicas=1),
+        restart_policy=docker.types.RestartPolicy(condition="none"))
+
+    # There is a period after the service's task is running but before the hub will
+    # accept connections. If the test code attempts to connect to the hub during that
+    # time, it fails, so wait until the API answers: this also covers the task start.
+    deadline = time.monotonic() + HUB_START_TIMEOUT
+    delay = 0.1
+    while True:
+        try:
+            http_session.get(HUB_API_URL, timeout=1)
+            break
+        except requests.RequestException:
+            if time.monotonic() > deadline:
+                raise
+            states = {task["Status"]["State"] for task in service.tasks()}
+            if states & HUB_TASK_ENDED:
+                raise RuntimeError("The hub service stopped: {}".format(states))
+            time.sleep(delay)
+            delay = min(delay * 2, 1.6)
 
     yield service
     service.remove()
+
+
+@pytest.fixture(scope="session")
+def http_session():
+    """A requests session, keeping the connections to the hub alive."""
+    import requests
+
+    with requests.Session() as session:
+        yield session
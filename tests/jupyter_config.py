@@ -11,13 +11,16 @@ c.JupyterHub.hub_ip = '0.0.0.0'
 # The name of the service that's running the hub
 c.SwarmSpawner.jupyterhub_service_name = "jupyterhub"
 
+# The tests find the user services by this prefix
+c.SwarmSpawner.service_prefix = "jupyter"
+
 # The name of the overlay network that everything's connected to
 c.SwarmSpawner.networks = ["jh_test"]
 
 
 c.SwarmSpawner.container_spec = {
     'args' : ['/usr/local/bin/start-singleuser.sh'],
-    'Image' : "jupyterhub/singleuser:0.8",
+    'Image' : "jupyterhub/singleuser:0.9.6",
     "mounts": []
     }
 
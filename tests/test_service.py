@@ -1,19 +1,72 @@
-import docker
-import requests
+import hashlib
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-def test_creates_service(hub_service):
-    """Test that logging in as a new user creates a new docker service."""
-    client = docker.from_env()
+import pytest
+
+# Services spawned by the hub are named <service_prefix>-<hash(username)>-<server_name>,
+# the daemon filters services by name prefix
+USER_SERVICES_FILTER = {"name": "jupyter-"}
+
+LOGIN_URL = "http://127.0.0.1:8000/hub/login?next="
+USERNAMES = ["user-{}".format(i) for i in range(3)]
+
+
+def service_name(username):
+    """The name of the service the hub spawns for a user: jupyter_config.py
+    keeps the default MD5 service_owner_hash."""
+    owner = hashlib.md5(username.encode("utf-8")).hexdigest()
+    return "jupyter-{}-1".format(owner)
+
+
+def login(username):
+    import requests
 
-    services_before_login = client.services.list()
+    # One session for each user, so that their cookies don't mix
+    with requests.Session() as session:
+        return session.post(LOGIN_URL,
+                            data={"username": username, "password": "just magnets"})
 
-    # This request should create a new docker service to run the server for a-new-user
-    response = requests.post("http://127.0.0.1:8000/hub/login?next=", data={"username": "a-new-user", "password": "just magnets"})
 
-    assert response.status_code == 200
+@pytest.fixture(scope="module")
+def spawned_services(hub_service, docker_client):
+    """Log in all the users at once, so that the hub spawns their services concurrently.
 
-    services_after_login = client.services.list()
-    assert len(services_after_login) - len(services_before_login) == 1
+    Yields the login responses and the new services, both by user name.
+    """
+    ids_before_login = {service.id for service
+                        in docker_client.services.list(filters=USER_SERVICES_FILTER)}
+    with ThreadPoolExecutor(max_workers=len(USERNAMES)) as executor:
+        future_responses = {username: executor.submit(login, username)
+                            for username in USERNAMES}
+        responses = {username: future.result()
+                     for username, future in future_responses.items()}
+
+    def new_services():
+        return {service.name: service for service
+                in docker_client.services.list(filters=USER_SERVICES_FILTER)
+                if service.id not in ids_before_login}
+
+    # The services may show up a little after the logins return
+    expected_names = {service_name(username) for username in USERNAMES}
+    for _ in range(50):
+        services = new_services()
+        if expected_names <= services.keys():
+            break
+        time.sleep(0.1)
+
+    yield responses, services
+
+    # Remove the services we just created, or we'll get errors when tearing down
+    # the fixtures
+    for service in new_services().values():
+        service.remove()
+
+
+@pytest.mark.parametrize("username", USERNAMES)
+def test_creates_service(spawned_services, username):
+    """Test that logging in as a new user creates a new docker service."""
+    responses, services = spawned_services
 
-    # Remove the service we just created, or we'll get errors when tearing down the fixtures
-    (set(services_after_login) - set(services_before_login)).pop().remove()
+    assert responses[username].status_code == 200
+    assert service_name(username) in services
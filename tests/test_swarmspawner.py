@@ -0,0 +1,302 @@
+"""Unit tests of the SwarmSpawner, against a stub of the docker APIClient."""
+
+import asyncio
+import hashlib
+import time
+from unittest import mock
+
+import docker
+import pytest
+from docker.errors import APIError
+from jupyterhub.spawner import Spawner
+
+from cassinyspawner import SwarmSpawner
+from cassinyspawner.swarmspawner import _compile_mount
+
+HOME_MOUNT = {"type": "volume", "source": "home-{username}", "target": "/home",
+              "driver_config": {"name": "local",
+                                "options": {"device": ":/exp/{username}",
+                                            "type": "nfs"}}}
+SHARED_MOUNT = {"type": "bind", "source": "/shared", "target": "/shared"}
+
+
+class StubClient:
+    """Keep the services in memory, and record the calls made to the daemon."""
+
+    def __init__(self):
+        self.services_by_name = {}
+        self.calls = []
+
+    def inspect_service(self, name):
+        self.calls.append("inspect_service")
+        if name not in self.services_by_name:
+            raise APIError("not found", response=mock.Mock(status_code=404))
+        return self.services_by_name[name]
+
+    def services(self, filters):
+        self.calls.append("services")
+        return [service for name, service in self.services_by_name.items()
+                if name.startswith(filters["name"])]
+
+    def create_service(self, task_tmpl, name, networks):
+        self.calls.append("create_service")
+        self.task_tmpl = task_tmpl
+        self.services_by_name[name] = {
+            "ID": "service1234567",
+            "Spec": {"Name": name, "TaskTemplate": task_tmpl}}
+        return {"ID": "service1234567"}
+
+    def tasks(self, filters):
+        self.calls.append("tasks")
+        return [{"ID": "task1234567", "Status": {"State": "running"}}]
+
+    def remove_service(self, service_id):
+        self.calls.append("remove_service")
+        self.services_by_name = {
+            name: service for name, service in self.services_by_name.items()
+            if not service["ID"].startswith(service_id)}
+
+
+@pytest.fixture
+def client(monkeypatch):
+    """Reset the state shared by the spawners, and use a stub client.
+
+    The client is set directly, so that the events thread is never started.
+    """
+    stub = StubClient()
+    # the env of the base Spawner needs a whole hub
+    monkeypatch.setattr(Spawner, "get_env",
+                        lambda self: {"JPY_API_TOKEN": self.api_token})
+    monkeypatch.setattr(SwarmSpawner, "_client", stub)
+    monkeypatch.setattr(SwarmSpawner, "_semaphore", None)
+    monkeypatch.setattr(SwarmSpawner, "_services_refresher", None)
+    monkeypatch.setattr(SwarmSpawner, "_compiled_container_spec", None)
+    monkeypatch.setattr(SwarmSpawner, "_service_cache", {})
+    monkeypatch.setattr(SwarmSpawner, "_service_invalidated", {})
+    monkeypatch.setattr(SwarmSpawner, "_service_state", {})
+    yield stub
+    if SwarmSpawner._services_refresher is not None:
+        SwarmSpawner._services_refresher.stop()
+
+
+def make_spawner(username="alice", **kwargs):
+    user = mock.Mock()
+    user.name = username
+    user.server.cookie_name = "jupyterhub-user-" + username
+    user.server.base_url = "/user/" + username
+    hub = mock.Mock()
+    hub.api_url = "http://127.0.0.1:8081/hub/api"
+    hub.server.base_url = "/hub"
+    kwargs.setdefault("service_cache_ttl", 0)
+    kwargs.setdefault("container_spec", {"Image": "singleuser", "args": ["start"],
+                                         "mounts": [HOME_MOUNT, SHARED_MOUNT]})
+    return SwarmSpawner(user=user, hub=hub, api_token="token",
+                        jupyterhub_service_name="jupyterhub", **kwargs)
+
+
+def run(coro):
+    """Run a coroutine in a new event loop, like asyncio.run of Python 3.7"""
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+
+
+def test_static_mount_is_shared():
+    build = _compile_mount(SHARED_MOUNT)
+
+    assert build("alice") is build("bob")
+    assert build("alice") == docker.types.Mount(target="/shared", source="/shared",
+                                                type="bind")
+
+
+def test_templated_mount_is_formatted_for_each_owner():
+    build = _compile_mount(HOME_MOUNT)
+
+    mount = build("alice")
+    assert mount["Source"] == "home-alice"
+    assert mount["VolumeOptions"]["DriverConfig"] == {
+        "Name": "local", "Options": {"device": ":/exp/alice", "type": "nfs"}}
+    assert build("bob")["Source"] == "home-bob"
+    # the spec itself isn't changed
+    assert HOME_MOUNT["driver_config"]["options"]["device"] == ":/exp/{username}"
+
+
+def test_service_cache(client):
+    spawner = make_spawner(service_cache_ttl=60)
+    client.services_by_name[spawner.service_name] = {
+        "ID": "service1234567", "Spec": {"Name": spawner.service_name}}
+
+    async def get_services():
+        first = await spawner.get_service()
+        second = await spawner.get_service()
+        return first, second
+
+    first, second = run(get_services())
+    assert first is second
+    assert client.calls == ["inspect_service"]
+
+    # an expired entry is inspected again
+    timestamp, service = SwarmSpawner._service_cache[spawner.service_name]
+    SwarmSpawner._service_cache[spawner.service_name] = (timestamp - 60, service)
+    run(spawner.get_service())
+    assert client.calls == ["inspect_service"] * 2
+
+    SwarmSpawner._invalidate_service(spawner.service_name)
+    run(spawner.get_service())
+    assert client.calls == ["inspect_service"] * 3
+
+
+def test_invalidated_service_is_not_cached_again(client):
+    since = time.monotonic()
+    SwarmSpawner._invalidate_service("jupyter-alice-1")
+    SwarmSpawner._cache_service("jupyter-alice-1", {"ID": "service1234567"}, since)
+
+    assert "jupyter-alice-1" not in SwarmSpawner._service_cache
+
+
+def test_refresh_services_cache(client):
+    spawner = make_spawner(service_cache_ttl=60)
+    client.services_by_name["jupyter-bob-1"] = {
+        "ID": "service1234567", "Spec": {"Name": "jupyter-bob-1"}}
+    client.services_by_name["other-bob-1"] = {
+        "ID": "other1234567", "Spec": {"Name": "other-bob-1"}}
+
+    # the refresher is started by the first inspection
+    run(spawner.get_service())
+    assert SwarmSpawner._services_refresher.callback_time == 30000
+
+    run(SwarmSpawner.refresh_services_cache(client, "jupyter"))
+    assert client.calls == ["inspect_service", "services"]
+    assert list(SwarmSpawner._service_cache) == ["jupyter-bob-1"]
+
+
+def test_start_ignores_cached_service(client):
+    spawner = make_spawner(service_cache_ttl=60)
+    SwarmSpawner._service_cache[spawner.service_name] = (
+        time.monotonic(), {"ID": "removed1234567"})
+
+    run(spawner.start())
+
+    assert client.calls == ["inspect_service", "create_service"]
+
+
+@pytest.mark.parametrize("name, expected", [
+    ("md5", hashlib.md5(b"alice").hexdigest()),
+    ("blake2b", hashlib.blake2b(b"alice", digest_size=16).hexdigest()),
+])
+def test_service_owner_hash(client, name, expected):
+    spawner = make_spawner(service_owner_hash=name)
+
+    assert spawner.service_owner == expected
+    assert spawner.service_name == "jupyter-{}-1".format(expected)
+
+
+def test_service_owner_hash_defaults_to_md5(client):
+    assert make_spawner().service_owner == hashlib.md5(b"alice").hexdigest()
+
+
+def service_event(name, action):
+    return {"Type": "service", "Action": action,
+            "Actor": {"ID": "service1234567", "Attributes": {"name": name}}}
+
+
+def test_start_poll_stop(client):
+    spawner = make_spawner()
+    owner = spawner.service_owner
+
+    async def lifecycle():
+        assert await spawner.poll() == 0
+        assert await spawner.start() == (spawner.service_name, 8888)
+        assert await spawner.poll() is None
+        await spawner.stop()
+        assert await spawner.poll() == 0
+
+    run(lifecycle())
+
+    container_spec = client.task_tmpl["ContainerSpec"]
+    assert container_spec["Image"] == "singleuser"
+    assert container_spec["Args"] == ["start"]
+    assert [m["Source"] for m in container_spec["Mounts"]] == [
+        "home-" + owner, "/shared"]
+    assert "JPY_HUB_API_URL=http://jupyterhub:8081/hub/api" in container_spec["Env"]
+    assert "create_service" in client.calls
+    assert "remove_service" in client.calls
+    assert spawner.service_id == ""
+
+
+def test_start_clears_removed_state(client):
+    spawner = make_spawner()
+    SwarmSpawner._record_event(service_event(spawner.service_name, "remove"),
+                               "jupyter", 60)
+
+    assert run(spawner.poll()) == 0
+    assert client.calls == []
+
+    run(spawner.start())
+    assert spawner.service_name not in SwarmSpawner._service_state
+
+
+def test_events_of_other_services_are_ignored(client):
+    SwarmSpawner._record_event(service_event("jupyterhub", "update"), "jupyter", 60)
+    SwarmSpawner._record_event(service_event("jupyter-alice-1", "update"),
+                               "jupyter", 60)
+
+    assert list(SwarmSpawner._service_state) == ["jupyter-alice-1"]
+    assert list(SwarmSpawner._service_invalidated) == ["jupyter-alice-1"]
+
+
+def test_removed_services_are_forgotten(client):
+    SwarmSpawner._record_event(service_event("jupyter-alice-1", "remove"),
+                               "jupyter", 60)
+    SwarmSpawner._record_event(service_event("jupyter-bob-1", "update"),
+                               "jupyter", 60)
+    SwarmSpawner._service_invalidated["jupyter-alice-1"] -= 60
+    SwarmSpawner._service_invalidated["jupyter-bob-1"] -= 60
+
+    SwarmSpawner._record_event(service_event("jupyter-carol-1", "remove"),
+                               "jupyter", 60)
+
+    assert SwarmSpawner._service_state == {"jupyter-bob-1": "update",
+                                           "jupyter-carol-1": "remove"}
+    assert list(SwarmSpawner._service_invalidated) == ["jupyter-carol-1"]
+
+
+def test_max_concurrent_docker_calls_defaults_to_executor_workers():
+    assert make_spawner(executor_workers=4).max_concurrent_docker_calls == 4
+    assert make_spawner(executor_workers=4,
+                        max_concurrent_docker_calls=2).max_concurrent_docker_calls == 2
+
+
+def test_start_reuses_api_token(client):
+    spawner = make_spawner()
+    client.services_by_name[spawner.service_name] = {
+        "ID": "service1234567",
+        "Spec": {"Name": spawner.service_name,
+                 "TaskTemplate": {"ContainerSpec": {
+                     "Env": ["JPY_USER=alice", "JPY_API_TOKEN=a=b"]}}}}
+
+    run(spawner.start())
+
+    assert spawner.api_token == "a=b"
+    assert "create_service" not in client.calls
+
+
+def test_container_spec_is_compiled_once(client):
+    spawner = make_spawner()
+    container_spec = {"Image": "singleuser", "env": {"A": "1"}, "mounts": []}
+
+    image, kwargs, builders = spawner._compile_container_spec(container_spec)
+    assert image == "singleuser"
+    assert "env" not in kwargs
+    assert spawner._compile_container_spec(dict(container_spec))[1] is kwargs
+
+    image, _, _ = spawner._compile_container_spec(
+        dict(container_spec, Image="other"))
+    assert image == "other"
+
+    with pytest.raises(ValueError):
+        spawner._compile_container_spec({"mounts": []})